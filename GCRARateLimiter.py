@@ -1,67 +1,154 @@
 import time
 import asyncio
-from tokencost import calculate_prompt_cost
+import functools
+import tiktoken
 from custom_logger import CustomLogger
 
+
+@functools.lru_cache(maxsize=8)
+def _enc(model):
+    """Return the tiktoken encoder for a model, loading it only once."""
+    return tiktoken.encoding_for_model(model)
+
+
+# Token counts per (model, content), so repeated prompts (system messages,
+# few-shot exemplars, retries) tokenize only once
+_token_count_cache = {}
+_TOKEN_CACHE_MAX = 4096
+
+
+def _count_message_tokens(model, contents):
+    """Token counts for a list of contents, served from the cache.
+
+    Misses are tokenized together through one encode_batch call, which
+    releases the GIL and runs in parallel in tiktoken's Rust layer.
+    """
+    # Evict before looking up misses: clearing afterwards would drop entries
+    # this call still needs and KeyError on the final lookup below
+    if len(_token_count_cache) >= _TOKEN_CACHE_MAX:
+        _token_count_cache.clear()
+    missing = [c for c in dict.fromkeys(contents) if (model, c) not in _token_count_cache]
+    if missing:
+        for content, tokens in zip(missing, _enc(model).encode_batch(missing)):
+            _token_count_cache[(model, content)] = len(tokens)
+    return [_token_count_cache[(model, c)] for c in contents]
+
+
+def count_tokens_cached(messages, model):
+    """Count the tokens in a message list using the cached encoder.
+
+    Handy for checking whether a shared prefix clears the ~1024-token
+    minimum that server-side prompt caching requires.
+    """
+    return sum(_count_message_tokens(model, [msg['content'] for msg in messages]))
+
+
 class GCRARateLimiter:
     def __init__(self, request_limit_per_minute, token_limit_per_minute, debug=False):
         self.request_limit = request_limit_per_minute
         self.token_limit = float(token_limit_per_minute)  # Convert to float for consistency
         self.debug = debug
 
-        self.last_request_time = 0
+        self.last_request_time = 0.0
         self.request_interval = 60 / self.request_limit
 
-        self.token_bucket = float(self.token_limit)  # Ensure the token bucket is initialized as float
-        self.last_token_fill_time = time.time()
-        self.token_fill_rate = float(self.token_limit / 60)  # tokens per second
+        # Bucket state is integer millitokens: exact, reproducible, no FP drift
+        self._cap_mt = int(self.token_limit * 1000)
+        self._tokens_mt = self._cap_mt
+        self._last_fill_ms = time.monotonic_ns() // 1_000_000
 
-        self.lock = asyncio.Lock()  # Lock for synchronizing access to the rate limiter
         self.logger = CustomLogger.get_instance()
 
-        self.logger.log("info", f"Rate limiter initialized: {self.request_limit} requests/min and {self.token_limit} tokens/min.")
+        self.logger.log("info", "Rate limiter initialized: %s requests/min and %s tokens/min.", self.request_limit, self.token_limit)
 
     def calculate_token_usage(self, messages, max_tokens, model, max_output_tokens):
         """Calculate the number of tokens required for a request, including a 50% buffer on the max output tokens."""
-        content = ' '.join([msg['content'] for msg in messages])
-        num_tokens = calculate_prompt_cost(content, model=model)  # Use dynamic model argument
-        num_tokens = float(num_tokens)  # Convert num_tokens to float
+        num_tokens = float(sum(_count_message_tokens(model, [msg['content'] for msg in messages])))
 
         # Add max_output_tokens + 50% buffer
         num_tokens += max_tokens + (max_output_tokens * 1.5)
 
-        self.logger.log("info", f"Calculated token usage: {num_tokens} tokens for model {model} (prompt + completion estimate with buffer)")
+        self.logger.log("debug", "Calculated token usage: %s tokens for model %s (prompt + completion estimate with buffer)", num_tokens, model)
         return num_tokens
 
+    @property
+    def token_bucket(self):
+        """Current bucket level in tokens (the internal unit is millitokens)."""
+        return self._tokens_mt / 1000
+
+    @token_bucket.setter
+    def token_bucket(self, value):
+        self._tokens_mt = int(value * 1000)
+
+    def try_acquire(self, num_tokens):
+        """Attempt to take num_tokens from the bucket without blocking.
+
+        Returns 0.0 on success (tokens deducted, request stamped), otherwise
+        the number of seconds to wait before retrying. Runs no awaits, so on
+        the event loop the whole refill/check/deduct sequence is atomic and
+        needs no lock.
+        """
+        now_ns = time.monotonic_ns()  # Immune to wall-clock jumps (NTP, DST)
+        current_time = now_ns / 1e9
+
+        # Refill in integer millitokens: elapsed_ms * capacity over the 60s window
+        now_ms = now_ns // 1_000_000
+        elapsed_ms = now_ms - self._last_fill_ms
+        self._tokens_mt = min(self._cap_mt, self._tokens_mt + elapsed_ms * self._cap_mt // 60_000)
+        self._last_fill_ms = now_ms
+
+        # A demand above capacity can never be satisfied: even a full bucket
+        # is too small, so waiting would just loop forever. Fail loudly instead.
+        need_mt = int(num_tokens * 1000)
+        if need_mt > self._cap_mt:
+            self.logger.log("error", "Requested %s tokens but the limit is %s tokens/min; the request can never pass.", num_tokens, self.token_limit)
+            raise ValueError(f"Requested {num_tokens} tokens but the limit is {self.token_limit} tokens/min; the request can never pass.")
+
+        # One combined wait: positive iff either limit is still blocking
+        request_wait = self.request_interval - (current_time - self.last_request_time)
+        token_wait = (need_mt - self._tokens_mt) * 60 / self._cap_mt
+        sleep_duration = max(0.0, request_wait, token_wait)
+        if sleep_duration > 0.0:
+            return sleep_duration
+
+        # Both limits satisfied: deduct and stamp, then report success
+        self._tokens_mt -= need_mt
+        self.last_request_time = current_time
+        self.logger.log("debug", "Token bucket after request: %s/%s tokens remaining.", self.token_bucket, self.token_limit)
+        return 0.0
+
+    def calibrate(self, remaining_tokens):
+        """Snap the bucket down to the server-reported remaining tokens.
+
+        The local bucket is only an estimate of the account-wide quota; when
+        a response header says fewer tokens remain than we think, trust the
+        server so the limiter converges to real capacity.
+        """
+        remaining_mt = int(remaining_tokens * 1000)
+        if remaining_mt < self._tokens_mt:
+            self._tokens_mt = remaining_mt
+            self.logger.log("debug", "Calibrated bucket down to server-reported %s tokens remaining.", remaining_tokens)
+
+    def reconcile_output_tokens(self, reserved, actual):
+        """Settle an up-front output reservation against actual usage.
+
+        Credits back the unused part of the reservation (or debits the
+        overage) so the bucket converges to real consumption instead of
+        charging both the estimate and the actual output.
+        """
+        delta_mt = int((reserved - actual) * 1000)
+        self._tokens_mt = min(self._cap_mt, self._tokens_mt + delta_mt)
+        self.logger.log("debug", "Reconciled output tokens: reserved %s, actual %s, bucket now %s.", reserved, actual, self.token_bucket)
+
     async def enforce_rate_limit_async(self, num_tokens):
-        """Asynchronous version of rate limit enforcement."""
-        async with self.lock:  # Ensure that rate limiting operations are atomic
-            current_time = time.time()
-
-            # Request rate limiting
-            time_since_last_request = current_time - self.last_request_time
-            if time_since_last_request < self.request_interval:
-                sleep_duration = self.request_interval - time_since_last_request
-                self.logger.log("info", f"Sleeping for {sleep_duration:.3f} seconds due to request rate limit.")
-                await asyncio.sleep(sleep_duration)
-
-            # Token bucket refill
-            time_since_last_fill = current_time - self.last_token_fill_time
-            self.token_bucket = min(self.token_limit, self.token_bucket + float(time_since_last_fill) * self.token_fill_rate)
-            self.last_token_fill_time = current_time
-
-            # Check if we have enough tokens
-            if num_tokens > self.token_bucket:
-                wait_time = (num_tokens - self.token_bucket) / self.token_fill_rate
-                self.logger.log("info", f"Sleeping for {wait_time:.3f} seconds to accumulate enough tokens.")
-                await asyncio.sleep(wait_time)
-                self.token_bucket = 0
-            else:
-                self.token_bucket -= num_tokens
-
-            if self.token_bucket < 0:
-                self.logger.log("warning", f"Warning: Token bucket is negative: {self.token_bucket}")
-                self.token_bucket = 0
-
-            self.logger.log("info", f"Token bucket after request: {self.token_bucket}/{self.token_limit} tokens remaining.")
-            self.last_request_time = time.time()
\ No newline at end of file
+        """Asynchronous version of rate limit enforcement.
+
+        Returns the number of tokens debited so the caller can reconcile
+        once the actual usage is known.
+        """
+        while True:
+            sleep_duration = self.try_acquire(num_tokens)
+            if sleep_duration <= 0:
+                return num_tokens
+            self.logger.log("debug", "Sleeping for %.3f seconds due to rate limits.", sleep_duration)
+            await asyncio.sleep(sleep_duration)
\ No newline at end of file
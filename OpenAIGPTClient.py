@@ -1,34 +1,64 @@
 import os
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 from custom_logger import CustomLogger
 
-# Load environment variables from the .env file
+# Load environment variables from the .env file, once at import
 print("Loading environment variables...", flush=True)
 load_dotenv()
+API_KEY = os.getenv('OPENAI_API_KEY')
 
 class OpenAIGPTClient:
-    def __init__(self, model, max_tokens=500, temperature=0.3, seed=42, debug=False):
-        self.api_key = os.getenv('OPENAI_API_KEY')
+    def __init__(self, model, max_tokens=500, temperature=0.3, seed=42, debug=False, batch_size=10, prompt_cache_key=None):
+        self.api_key = API_KEY
         self.debug = debug
         self.model = model
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.seed = seed
+        self.batch_size = batch_size
+        self.prompt_cache_key = prompt_cache_key
+        self._session = None  # Created lazily inside the running event loop
         self.logger = CustomLogger.get_instance()
 
         if not self.api_key:
             self.logger.log("error", "API key is not set. Please set the OPENAI_API_KEY environment variable.")
             raise ValueError("API key is not set. Please set the OPENAI_API_KEY environment variable.")
         self.endpoint = "https://api.openai.com/v1/chat/completions"
-        self.logger.log("info", f"Client initialized with model: {self.model}.")
+        self.logger.log("info", "Client initialized with model: %s.", self.model)
 
-    async def make_api_call(self, messages):
-        """Handles making the actual API call asynchronously using aiohttp."""
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+    def _get_session(self):
+        """Return the shared ClientSession, creating it on first use.
+
+        The session (and its TCP connector) is created lazily so it binds to
+        the running event loop, and is reused across calls so batches keep
+        warm TLS connections instead of re-handshaking per request.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.batch_size, ttl_dns_cache=300, keepalive_timeout=75)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.api_key}"
+                }
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared session and its connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def build_request_body(self, messages):
+        """Serialize the request payload once so retries can reuse the bytes.
+
+        When prompt_cache_key is set it is sent with every request so OpenAI
+        routes requests sharing the key to the same prompt cache. To benefit,
+        keep the immutable content (system prompt, instructions, few-shots)
+        at the front of messages and vary only the trailing user turn.
+        """
         data = {
             "model": self.model,
             "messages": messages,
@@ -36,25 +66,42 @@ class OpenAIGPTClient:
             "max_tokens": self.max_tokens,
             "seed": self.seed
         }
+        if self.prompt_cache_key is not None:
+            data["prompt_cache_key"] = self.prompt_cache_key
+        return orjson.dumps(data)
+
+    async def make_api_call(self, messages, *, body_bytes=None):
+        """Handles making the actual API call asynchronously using aiohttp."""
+        if body_bytes is None:
+            body_bytes = self.build_request_body(messages)
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                self.logger.log("info", f"Sending request for model: {self.model} with {self.max_tokens} max tokens")
+        session = self._get_session()
+        try:
+            self.logger.log("debug", "Sending request for model: %s with %s max tokens", self.model, self.max_tokens)
 
-                async with session.post(self.endpoint, headers=headers, json=data) as response:
-                    response.raise_for_status()  # Raise an error for bad responses
+            async with session.post(self.endpoint, data=body_bytes) as response:
+                response.raise_for_status()  # Raise an error for bad responses
 
-                    result = await response.json()
+                result = orjson.loads(await response.read())
 
-                    # Calculate the total tokens used
-                    response_tokens = len(result['choices'][0]['message']['content'].split())
-                    self.logger.log("info", f"Response tokens: {response_tokens}")
+                # Take the exact token counts the API reports rather than estimating
+                usage = result['usage']
+                response_tokens = usage['completion_tokens']
+                prompt_tokens = usage['prompt_tokens']
+                self.logger.log("debug", "Response tokens: %s (prompt tokens: %s)", response_tokens, prompt_tokens)
 
-                    return result['choices'][0]['message']['content'].strip(), response_tokens
+                # Hand back the rate-limit headers so the caller can pace itself
+                return result['choices'][0]['message']['content'].strip(), response_tokens, prompt_tokens, response.headers
 
-            except aiohttp.ClientError as http_err:
-                self.logger.log("error", f"HTTP error occurred: {http_err}")
-                return f"HTTP error occurred: {http_err}", 0
-            except Exception as err:
-                self.logger.log("error", f"An error occurred: {err}")
-                return f"An error occurred: {err}", 0
\ No newline at end of file
+        except aiohttp.ClientResponseError as http_err:
+            if http_err.status in (429, 503):
+                # Rate limited or overloaded: let the caller back off using Retry-After
+                raise
+            self.logger.log("error", "HTTP error occurred: %s", http_err)
+            return f"HTTP error occurred: {http_err}", 0, 0, {}
+        except aiohttp.ClientError as http_err:
+            self.logger.log("error", "HTTP error occurred: %s", http_err)
+            return f"HTTP error occurred: {http_err}", 0, 0, {}
+        except Exception as err:
+            self.logger.log("error", "An error occurred: %s", err)
+            return f"An error occurred: {err}", 0, 0, {}
\ No newline at end of file
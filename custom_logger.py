@@ -1,4 +1,7 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import requests
 import os
 from rich.console import Console
@@ -42,34 +45,47 @@ class CustomLogger:
             show_path=True,
             omit_repeated_times=False,  # This ensures timestamps repeat on new lines
         )
-        # Set up the formatter without time, as RichHandler handles that
-        self.logger.addHandler(rich_handler)
-
         # Add file handler with a detailed format
         file_handler = logging.FileHandler(log_file_path)
         file_handler.setLevel(logging.DEBUG)
         # Here we keep the timestamp, level, filename, and line number in log files
         file_format = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
         file_handler.setFormatter(file_format)
-        self.logger.addHandler(file_handler)
+
+        # Route records through a queue so console rendering and file writes
+        # happen on a background thread instead of blocking the event loop
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(log_queue))
+        self._listener = QueueListener(log_queue, rich_handler, file_handler, respect_handler_level=True)
+        self._listener.start()
+        # Drain any queued records before the interpreter exits; the listener
+        # thread is a daemon, so without this trailing logs can be dropped
+        atexit.register(self._listener.stop)
 
         self._initialized = True
 
-    def log(self, level, message):
+    _LEVELS = {
+        "debug": logging.DEBUG,
+        "info": logging.INFO,
+        "warning": logging.WARNING,
+        "error": logging.ERROR,
+        "critical": logging.CRITICAL,
+    }
+
+    def log(self, level, message, *args):
+        """Log a message with lazy %-style formatting.
+
+        Pass format arguments separately (e.g. log("info", "Task %s done", task_id))
+        so the string is only built when the level is actually enabled.
+        """
         if level == "debug" and not self.debug_mode:
             return
-        if level == "debug":
-            self.logger.debug(message, stacklevel=2)
-        elif level == "info":
-            self.logger.info(message, stacklevel=2)
-        elif level == "warning":
-            self.logger.warning(message, stacklevel=2)
-        elif level == "error":
-            self.logger.error(message, stacklevel=2)
-            self._send_error_notification(message)
-        elif level == "critical":
-            self.logger.critical(message, stacklevel=2)
-            self._send_error_notification(message)
+        lvl = self._LEVELS.get(level, logging.INFO)
+        if not self.logger.isEnabledFor(lvl):
+            return
+        self.logger.log(lvl, message, *args, stacklevel=2)
+        if lvl >= logging.ERROR:
+            self._send_error_notification(message % args if args else message)
 
     def log_exception(self, ex):
         self.logger.exception(f"Exception occurred: {str(ex)}", stacklevel=2)
@@ -1,143 +1,147 @@
-import json
 import asyncio
+import orjson
+from array import array
 from OpenAIGPTClient import OpenAIGPTClient
 from GCRARateLimiter import GCRARateLimiter
 from custom_logger import CustomLogger
 import aiohttp
 
+# Prefer uvloop's libuv event loop when available; fall back to stock asyncio
+# (e.g. on Windows, where uvloop does not build)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Load the limits JSON file
-with open('limits.json') as f:
-    model_limits = json.load(f)
+with open('limits.json', 'rb') as f:
+    model_limits = orjson.loads(f.read())
+
+# Configure logging once at import instead of per send_requests call
+LOGGER = CustomLogger.initialize_from_env()
+
+async def send_requests(model, messages_list, max_tokens=50, debug=False, task_timeout=30, max_retries=3, batch_size=10, cache_key=None):
+    """Send all message lists through the rate limiter and the OpenAI API.
 
-async def send_requests(model, messages_list, max_tokens=50, debug=False, task_timeout=30, max_retries=3, batch_size=10):
-    # Initialize custom logger
-    logger = CustomLogger.initialize_from_env()
+    cache_key, when given, is forwarded as the request's prompt_cache_key so
+    requests sharing a prompt prefix hit OpenAI's server-side prompt cache.
+    Put the shared system/instruction messages first in each message list so
+    the prefix actually matches across requests.
+    """
+    logger = LOGGER
 
     # Load limits based on the selected model
     limits = model_limits.get(model)
     if not limits:
-        logger.log("error", f"Model {model} is not supported or limits are not available.")
+        logger.log("error", "Model %s is not supported or limits are not available.", model)
         raise ValueError(f"Model {model} is not supported or limits are not available.")
     
     request_limit = limits["request_limit_per_minute"]
     token_limit = limits["token_limit_per_minute"]
 
     # Initialize the client and rate limiter
-    client = OpenAIGPTClient(model=model, max_tokens=max_tokens, debug=debug)
+    client = OpenAIGPTClient(model=model, max_tokens=max_tokens, debug=debug, batch_size=batch_size, prompt_cache_key=cache_key)
     limiter = GCRARateLimiter(request_limit_per_minute=request_limit, token_limit_per_minute=token_limit, debug=debug)
 
     logger.log("info", "Initialized client and rate limiter.")
     
-    # Summary variables
+    # Summary counters packed into one array: input tokens, output tokens,
+    # successful tasks, max output tokens (basis for the 50% reserve buffer)
     total_tasks = len(messages_list)
-    total_input_tokens = 0
-    total_output_tokens = 0
-    total_successful_tasks = 0
+    stats = array('q', [0, 0, 0, 0])
 
-    # Track max token usage of the outputs and add 50% buffer
-    max_output_tokens = 0
+    # Bound the number of in-flight requests; everything else is scheduled up front
+    semaphore = asyncio.Semaphore(batch_size)
 
     async def send_single_request(messages, task_id):
-        nonlocal total_input_tokens, total_output_tokens, total_successful_tasks, max_output_tokens
-        attempt = 0
-        while attempt < max_retries:
-            try:
-                logger.log("info", f"Task {task_id}: Starting request with messages: {messages}")
-
-                # Calculate tokens for this request including 50% buffer on max_output_tokens
-                num_tokens = limiter.calculate_token_usage(messages, max_tokens, model, max_output_tokens)
-                total_input_tokens += num_tokens
-
-                # Enforce rate limiting before making the request
-                await limiter.enforce_rate_limit_async(num_tokens)
-
-                logger.log("info", f"Task {task_id}: Rate limit passed, sending request.")
-
-                # Make the actual API call with a timeout to avoid hanging tasks
-                response, response_tokens = await asyncio.wait_for(
-                    client.make_api_call(messages),
-                    timeout=task_timeout
-                )
-
-                # Count output tokens and adjust token usage
-                total_output_tokens += response_tokens
-                limiter.token_bucket -= response_tokens  # Deduct the output tokens from the bucket
+        async with semaphore:
+            # Serialize the payload once; retries resend the same bytes
+            body_bytes = client.build_request_body(messages)
+            attempt = 0
+            while attempt < max_retries:
+                try:
+                    logger.log("debug", "Task %s: Starting request with messages: %s", task_id, messages)
+
+                    # Calculate tokens for this request including 50% buffer on max_output_tokens
+                    output_reserve = max_tokens + stats[3] * 1.5
+                    num_tokens = limiter.calculate_token_usage(messages, max_tokens, model, stats[3])
+
+                    # Enforce rate limiting before making the request
+                    await limiter.enforce_rate_limit_async(num_tokens)
+
+                    logger.log("debug", "Task %s: Rate limit passed, sending request.", task_id)
+
+                    # Make the actual API call with a timeout to avoid hanging tasks
+                    response, response_tokens, prompt_tokens, resp_headers = await asyncio.wait_for(
+                        client.make_api_call(messages, body_bytes=body_bytes),
+                        timeout=task_timeout
+                    )
+
+                    # Count token usage with the exact numbers the API reported
+                    stats[0] += prompt_tokens
+                    stats[1] += response_tokens
+
+                    # Settle the up-front output reservation against actual usage
+                    limiter.reconcile_output_tokens(output_reserve, response_tokens)
+
+                    # Let the server-reported remaining quota pull the bucket down
+                    remaining_tokens = resp_headers.get('x-ratelimit-remaining-tokens')
+                    if remaining_tokens is not None:
+                        limiter.calibrate(float(remaining_tokens))
+
+                    # Update the max output tokens if this response exceeds the previous max
+                    if response_tokens > stats[3]:
+                        stats[3] = response_tokens
+
+                    logger.log("debug", "Task %s: Response received: %s (Response tokens: %s)", task_id, response, response_tokens)
+                
+                    # Increment successful task counter
+                    stats[2] += 1
 
-                # Update max_output_tokens if current response tokens exceed the previous max
-                if response_tokens > max_output_tokens:
-                    max_output_tokens = response_tokens
+                    # Successful completion, break out of retry loop
+                    break
 
-                logger.log("info", f"Task {task_id}: Response received: {response} (Response tokens: {response_tokens})")
-                
-                # Increment successful task counter
-                total_successful_tasks += 1
-
-                # Successful completion, break out of retry loop
-                break
-
-            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
-                attempt += 1
-                if attempt < max_retries:
-                    wait_time = 2 ** attempt  # Exponential backoff
-                    logger.log("warning", f"Task {task_id}: Retry {attempt}/{max_retries} after {wait_time} seconds due to error: {e}")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.log("error", f"Task {task_id}: Failed after {max_retries} retries.")
+                except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                    attempt += 1
+                    if attempt < max_retries:
+                        wait_time = 2 ** attempt  # Exponential backoff when the server gives no hint
+                        retry_after = getattr(e, 'headers', None) and e.headers.get('Retry-After')
+                        if retry_after:
+                            try:
+                                wait_time = float(retry_after)
+                            except ValueError:
+                                pass  # Non-numeric Retry-After: keep the exponential fallback
+                        logger.log("warning", "Task %s: Retry %s/%s after %s seconds due to error: %s", task_id, attempt, max_retries, wait_time, e)
+                        await asyncio.sleep(wait_time)
+                    else:
+                        logger.log("error", "Task %s: Failed after %s retries.", task_id, max_retries)
+                        break
+                except asyncio.CancelledError:
+                    logger.log("info", "Task %s: Cancelled.", task_id)
                     break
-            except asyncio.CancelledError:
-                logger.log("info", f"Task {task_id}: Cancelled.")
-                break
-            except Exception as e:
-                logger.log("error", f"Task {task_id}: Exception occurred: {e}")
-                break
-            finally:
-                logger.log("info", f"Task {task_id}: Completed or Cancelled.")
-
-    # Split messages into batches
-    batches = [messages_list[i:i + batch_size] for i in range(0, len(messages_list), batch_size)]
-
-    for batch_idx, batch in enumerate(batches):
-        logger.log("info", f"Processing batch {batch_idx + 1}/{len(batches)}...")
-
-        tasks = []
-        task_to_message = {}  # Track messages associated with tasks
-        for idx, messages in enumerate(batch):
-            task = asyncio.create_task(send_single_request(messages, idx))
-            tasks.append(task)
-            task_to_message[task] = messages  # Map task to its corresponding message
-
-        try:
-            while tasks:
-                # Wait for at least one task to complete
-                done, pending = await asyncio.wait(tasks, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
-
-                # Update the list of pending tasks
-                tasks = [task for task in tasks if not task.done()]
-
-                # Log details about pending tasks
-                logger.log("info", f"Pending tasks: {len(pending)} | Completed tasks: {len(done)}")
-
-                # Log the current state of the token bucket
-                logger.log("info", f"Token bucket state: {limiter.token_bucket}/{limiter.token_limit} tokens remaining")
-
-                # If all tasks are completed, break the loop
-                if not tasks:
+                except Exception as e:
+                    logger.log("error", "Task %s: Exception occurred: %s", task_id, e)
                     break
+                finally:
+                    logger.log("debug", "Task %s: Completed or Cancelled.", task_id)
 
-        except asyncio.CancelledError:
-            logger.log("warning", "All tasks were cancelled.")
-        finally:
-            # Ensure tasks are cancelled properly if they are not done
-            for task in tasks:
-                if not task.done():
-                    task.cancel()
+    try:
+        # Schedule everything at once; the semaphore caps how many run concurrently
+        tasks = [
+            asyncio.create_task(send_single_request(messages, idx))
+            for idx, messages in enumerate(messages_list)
+        ]
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-            await asyncio.gather(*tasks, return_exceptions=True)
-            logger.log("info", f"Batch {batch_idx + 1}/{len(batches)} completed or cancelled.")
+    finally:
+        # Release the client's pooled connections once the run is over
+        await client.close()
 
     # Log summary
+    total_input_tokens, total_output_tokens, total_successful_tasks, _ = stats
     logger.log("info", "Summary:")
-    logger.log("info", f"Total tasks: {total_tasks}")
-    logger.log("info", f"Total successful tasks: {total_successful_tasks}")
-    logger.log("info", f"Total input tokens: {total_input_tokens}")
-    logger.log("info", f"Total output tokens: {total_output_tokens}")
+    logger.log("info", "Total tasks: %s", total_tasks)
+    logger.log("info", "Total successful tasks: %s", total_successful_tasks)
+    logger.log("info", "Total input tokens: %s", total_input_tokens)
+    logger.log("info", "Total output tokens: %s", total_output_tokens)